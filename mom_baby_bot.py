@@ -1,22 +1,54 @@
 import asyncio
+import calendar
+import functools
+import heapq
+import html
+import itertools
+import logging
+import secrets
+import sys
 import time
 import sqlite3
-from datetime import datetime, date, timedelta, timezone
+import threading
+from contextlib import suppress
+from datetime import MAXYEAR, MINYEAR, datetime, date, timedelta, timezone
 from aiogram import Bot, Dispatcher, types, F
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.filters import Command
+from aiogram.filters.callback_data import CallbackData
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
 import os
 import csv
-from io import StringIO, BytesIO
+from io import BytesIO, TextIOWrapper
+
+try:
+    import uvloop  # Быстрый event loop на libuv; на Windows недоступен
+except ImportError:
+    uvloop = None
 
 # ========== КОНФИГУРАЦИЯ ==========
+logging.basicConfig(level=logging.INFO, stream=sys.stderr,
+                    format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+log = logging.getLogger(__name__)
+
 API_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
 if not API_TOKEN:
     raise ValueError("TELEGRAM_BOT_TOKEN не установлен в переменных окружения!")
 
+# Вебхук: если WEBHOOK_URL не задан, бот работает через long polling
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')  # Публичный адрес, например https://bot.example.com
+WEBHOOK_PATH = '/telegram'
+# Telegram присылает его в заголовке X-Telegram-Bot-Api-Secret-Token; чужие запросы отбрасываются.
+# Если не задан, генерируется при старте: set_webhook все равно вызывается при каждом запуске
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET') or secrets.token_urlsafe(32)
+WEBAPP_HOST = os.getenv('WEBAPP_HOST', '0.0.0.0')
+WEBAPP_PORT = int(os.getenv('WEBAPP_PORT', '8080'))
+
 bot = Bot(token=API_TOKEN)
 storage = MemoryStorage()
 dp = Dispatcher(storage=storage)
@@ -60,18 +92,134 @@ class BabyStates(StatesGroup):
     choosing_calendar_month = State()
     choosing_category_report = State()
 
+# ========== КОНСТАНТЫ ==========
+_EMOJI = {'ГВ': '🍼', 'Сон': '😴', 'Смесь': '🍶'}
+_CATEGORY_FROM_BTN = {'🍼 ГВ': 'ГВ', '😴 Сон': 'Сон', '🍶 Смесь': 'Смесь'}
+# Префиксы callback_data (ключи CALLBACK_ROUTES): интернированы, чтобы
+# поиск в таблице маршрутов сравнивал строки по указателю
+_CAL, _DATE, _CAT, _CANCEL_CAL, _CANCEL_CAT, _NOOP = map(
+    sys.intern, ('cal', 'date', 'cat', 'cancel_calendar', 'cancel_cat', 'noop'))
+
+# Типизированные callback_data: pack() для кнопок, unpack() в обработчиках
+class CalCB(CallbackData, prefix=_CAL):
+    year: int
+    month: int
+
+class DateCB(CallbackData, prefix=_DATE):
+    year: int
+    month: int
+    day: int
+
+class CatCB(CallbackData, prefix=_CAT):
+    name: str
+
+_TIMEZONE_MAP = {
+    '🇷🇺 Москва (UTC+3)': 'Europe/Moscow',
+    '🇬🇪 Батуми (UTC+4)': 'Asia/Tbilisi',
+    '🇷🇺 Самара (UTC+4)': 'Europe/Samara',
+    '🇷🇺 Екатеринбург (UTC+5)': 'Asia/Yekaterinburg',
+    '🇬🇧 Лондон (UTC+0)': 'Europe/London',
+    '🇹🇭 Бангкок (UTC+7)': 'Asia/Bangkok',
+    '⏭️ Пропустить': 'Europe/Moscow'
+}
+
 # ========== ГЛОБАЛЬНЫЕ ПЕРЕМЕННЫЕ ==========
-active_timers = {}  # {user_id: {'start': time, 'category': str, 'date': str}}
-reminder_tasks = {}  # {user_id: asyncio.Task} для уведомлений
+active_timer_users = set()  # Кэш таблицы active_sessions: у кого сейчас идет таймер
+_reminders = []  # Куча (время срабатывания, seq, user_id, category, interval)
+_reminder_seq = {}  # {user_id: seq} — актуальное напоминание; остальные в куче устарели
+_reminder_counter = itertools.count(1)  # Общий на всех: seq никогда не повторяется
+_reminders_changed = asyncio.Event()  # Будит планировщик при новом напоминании
+_name_cache = {}  # {user_id: baby_name} — сбрасывается при изменении имени
+_tz_cache = {}  # {user_id: SimpleTimezone} — сбрасывается при смене пояса
+_interval_cache = {}  # {(user_id, category): (истекает, интервал)} — сбрасывается при новой записи
+INTERVAL_CACHE_TTL = 60  # Время жизни кэша средних интервалов (сек)
+INTERVAL_CACHE_MAXSIZE = 4096  # При переполнении выбрасываются истекшие записи
+WRITE_QUEUE = asyncio.Queue()  # (строка baby_logs, asyncio.Future с id записи)
+WRITE_BATCH_SIZE = 50  # Максимум записей в одной транзакции
+WRITE_FLUSH_DELAY = 0.1  # Сколько ждать попутные записи перед сбросом (сек)
+DB_OPTIMIZE_INTERVAL = 6 * 3600  # Период PRAGMA optimize (сек)
+_last_cal_view = {}  # {chat_id: (message_id, year, month)} — последний календарь чата; одна запись на чат
+CALLBACK_CONCURRENCY = 32  # Сколько нажатий инлайн-кнопок обрабатывается одновременно
+_callback_sem = asyncio.Semaphore(CALLBACK_CONCURRENCY)
+
+# ========== SQL-ЗАПРОСЫ ==========
+# Тексты запросов вынесены в константы: одинаковая строка попадает в кэш
+# скомпилированных выражений соединения и не разбирается заново
+SQL_UPSERT_USER = '''
+    INSERT OR REPLACE INTO users (user_id, username, first_name, baby_name, joined_date)
+    VALUES (?, ?, ?, COALESCE(?, (SELECT baby_name FROM users WHERE user_id = ?)), 
+            COALESCE((SELECT joined_date FROM users WHERE user_id = ?), ?))
+'''
+SQL_GET_BABY_NAME = 'SELECT baby_name FROM users WHERE user_id = ?'
+SQL_UPDATE_BABY_NAME = 'UPDATE users SET baby_name = ? WHERE user_id = ?'
+SQL_GET_TZ = 'SELECT timezone FROM user_timezones WHERE user_id = ?'
+SQL_SAVE_TZ = 'INSERT OR REPLACE INTO user_timezones (user_id, timezone) VALUES (?, ?)'
+SQL_AVERAGE_INTERVAL = '''
+    WITH recent AS (
+        SELECT date, time_start, julianday(date || ' ' || time_start) AS ts
+        FROM baby_logs 
+        WHERE user_id = ? AND category = ?
+        ORDER BY date DESC, time_start DESC
+        LIMIT 10
+    )
+    SELECT AVG(ABS(ROUND((ts - prev_ts) * 86400)))
+    FROM (SELECT ts, LAG(ts) OVER (ORDER BY date DESC, time_start DESC) AS prev_ts FROM recent)
+'''
+SQL_CATEGORY_STATS = '''
+    SELECT category, COUNT(*), SUM(duration), AVG(volume)
+    FROM baby_logs 
+    WHERE user_id = ? AND category IN ('ГВ', 'Сон', 'Смесь')
+    GROUP BY category
+'''
+SQL_USER_CATEGORIES = 'SELECT DISTINCT category FROM baby_logs WHERE user_id = ? ORDER BY category'
+SQL_INSERT_LOG = '''
+    INSERT INTO baby_logs (user_id, category, duration, volume, date, time_start, description)
+    VALUES (?, ?, ?, ?, ?, ?, NULL)
+    RETURNING id
+'''
+SQL_UPDATE_DESCRIPTION = 'UPDATE baby_logs SET description = ? WHERE id = ? AND user_id = ?'
+SQL_LOGS_FOR_DATE = '''
+    SELECT category, duration, volume, time_start, description
+    FROM baby_logs
+    WHERE user_id = ? AND date = ?
+    ORDER BY time_start
+'''
+SQL_LOGS_FOR_CATEGORY = '''
+    SELECT date, duration, volume, time_start, description
+    FROM baby_logs
+    WHERE user_id = ? AND category = ?
+    ORDER BY date DESC, time_start DESC
+    LIMIT 20
+'''
+SQL_START_SESSION = 'INSERT OR IGNORE INTO active_sessions (user_id, start_ts, category, date) VALUES (?, ?, ?, ?)'
+SQL_STOP_SESSION = 'DELETE FROM active_sessions WHERE user_id = ? RETURNING start_ts, category, date'
+SQL_ACTIVE_SESSIONS = 'SELECT user_id FROM active_sessions'
+SQL_EXPORT_LOGS = '''
+    SELECT date, time_start, category, duration, volume, description
+    FROM baby_logs
+    WHERE user_id = ?
+    ORDER BY date DESC, time_start DESC
+'''
 
 # ========== ИНИЦИАЛИЗАЦИЯ БД ==========
+# Одно долгоживущее соединение на весь процесс (autocommit, WAL)
+DB = sqlite3.connect('baby_logs.db', check_same_thread=False, isolation_level=None, cached_statements=256)
+DB_LOCK = threading.Lock()
+
 def init_db():
-    """Создает таблицы БД при первом запуске"""
-    conn = sqlite3.connect('baby_logs.db')
-    cursor = conn.cursor()
+    """Настраивает соединение и создает таблицы БД при первом запуске"""
+    for pragma in (
+        'PRAGMA journal_mode=WAL',
+        'PRAGMA synchronous=NORMAL',
+        'PRAGMA temp_store=MEMORY',
+        'PRAGMA cache_size=-64000',
+        'PRAGMA mmap_size=30000000000',
+        'PRAGMA foreign_keys=ON',
+    ):
+        DB.execute(pragma)
     
     # Таблица для логов активностей
-    cursor.execute('''
+    DB.execute('''
         CREATE TABLE IF NOT EXISTS baby_logs (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             user_id INTEGER,
@@ -85,7 +233,7 @@ def init_db():
     ''')
     
     # Таблица для часовых поясов
-    cursor.execute('''
+    DB.execute('''
         CREATE TABLE IF NOT EXISTS user_timezones (
             user_id INTEGER PRIMARY KEY,
             timezone TEXT
@@ -93,7 +241,7 @@ def init_db():
     ''')
     
     # Таблица для пользователей с именем ребенка
-    cursor.execute('''
+    DB.execute('''
         CREATE TABLE IF NOT EXISTS users (
             user_id INTEGER PRIMARY KEY,
             username TEXT,
@@ -103,123 +251,272 @@ def init_db():
         )
     ''')
     
-    conn.commit()
-    conn.close()
+    # Таблица запущенных таймеров (переживает перезапуск бота)
+    DB.execute('''
+        CREATE TABLE IF NOT EXISTS active_sessions (
+            user_id INTEGER PRIMARY KEY,
+            start_ts REAL,
+            category TEXT,
+            date TEXT
+        )
+    ''')
+    
+    # Индексы под отчеты: по дате и по категории (в т.ч. агрегаты статистики)
+    DB.execute('CREATE INDEX IF NOT EXISTS idx_logs_user_date ON baby_logs(user_id, date DESC, time_start DESC)')
+    DB.execute('CREATE INDEX IF NOT EXISTS idx_logs_user_category_date ON baby_logs(user_id, category, date DESC, time_start DESC)')
+    DB.execute('ANALYZE')
+
+def optimize_db():
+    """Обновляет статистику планировщика запросов"""
+    with DB_LOCK:
+        DB.execute('PRAGMA optimize')
+
+def close_db():
+    """Оптимизирует БД, сбрасывает WAL в основной файл и закрывает соединение"""
+    with DB_LOCK:
+        DB.execute('PRAGMA optimize')
+        DB.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        DB.close()
+
+async def optimize_db_periodically():
+    """Фоновая задача: периодический PRAGMA optimize для долгоживущего процесса"""
+    while True:
+        await asyncio.sleep(DB_OPTIMIZE_INTERVAL)
+        try:
+            await asyncio.to_thread(optimize_db)
+        except Exception as e:
+            log.error('Ошибка оптимизации БД: %s', e)
 
 init_db()
 
 # ========== ФУНКЦИИ ДЛЯ РАБОТЫ С БД ==========
+def load_active_sessions():
+    """Заполняет кэш active_timer_users из БД при старте"""
+    with DB_LOCK:
+        rows = DB.execute(SQL_ACTIVE_SESSIONS).fetchall()
+        active_timer_users.update(user_id for user_id, in rows)
+
+def start_session(user_id: int, category: str, date_str: str) -> bool:
+    """Запускает таймер; False, если у пользователя уже идет отсчет"""
+    start_ts = time.time()
+    with DB_LOCK:
+        started = DB.execute(SQL_START_SESSION, (user_id, start_ts, category, date_str)).rowcount == 1
+        # Под той же блокировкой, что и таблица, иначе параллельный стоп может разойтись с кэшем
+        if started:
+            active_timer_users.add(user_id)
+    return started
+
+def stop_session(user_id: int):
+    """Останавливает таймер, возвращает (start_ts, category, date) или None"""
+    with DB_LOCK:
+        rows = DB.execute(SQL_STOP_SESSION, (user_id,)).fetchall()
+        active_timer_users.discard(user_id)
+    return rows[0] if rows else None
+
 def log_user(user_id: int, username: str, first_name: str, baby_name: str = None):
     """Регистрирует или обновляет пользователя"""
-    conn = sqlite3.connect('baby_logs.db')
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT OR REPLACE INTO users (user_id, username, first_name, baby_name, joined_date)
-        VALUES (?, ?, ?, COALESCE(?, (SELECT baby_name FROM users WHERE user_id = ?)), 
-                COALESCE((SELECT joined_date FROM users WHERE user_id = ?), ?))
-    ''', (user_id, username or 'unknown', first_name or 'User', baby_name, user_id, user_id, date.today().isoformat()))
-    conn.commit()
-    conn.close()
+    with DB_LOCK:
+        DB.execute(SQL_UPSERT_USER, (user_id, username or 'unknown', first_name or 'User', baby_name, user_id, user_id, date.today().isoformat()))
+        if baby_name is not None:
+            _name_cache.pop(user_id, None)
 
 def get_baby_name(user_id: int) -> str:
-    """Получает имя ребенка"""
-    conn = sqlite3.connect('baby_logs.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT baby_name FROM users WHERE user_id = ?', (user_id,))
-    result = cursor.fetchone()
-    conn.close()
-    return result[0] if result and result[0] else 'Малыш'
+    """Получает имя ребенка (из кэша, если уже загружено)"""
+    if user_id in _name_cache:
+        return _name_cache[user_id]
+    with DB_LOCK:
+        result = DB.execute(SQL_GET_BABY_NAME, (user_id,)).fetchone()
+        baby_name = result[0] if result and result[0] else 'Малыш'
+        # Под блокировкой, чтобы параллельное обновление имени не оставило в кэше старое
+        _name_cache[user_id] = baby_name
+    return baby_name
+
+async def get_baby_name_async(user_id: int) -> str:
+    """Имя ребенка без блокировки event loop: БД читается в потоке только при промахе кэша"""
+    if user_id in _name_cache:
+        return _name_cache[user_id]
+    return await asyncio.to_thread(get_baby_name, user_id)
 
 def update_baby_name(user_id: int, baby_name: str):
     """Обновляет имя ребенка"""
-    conn = sqlite3.connect('baby_logs.db')
-    cursor = conn.cursor()
-    cursor.execute('UPDATE users SET baby_name = ? WHERE user_id = ?', (baby_name, user_id))
-    conn.commit()
-    conn.close()
+    with DB_LOCK:
+        DB.execute(SQL_UPDATE_BABY_NAME, (baby_name, user_id))
+        _name_cache.pop(user_id, None)
 
 def get_user_tz(user_id: int) -> SimpleTimezone:
-    """Получает часовой пояс пользователя"""
-    conn = sqlite3.connect('baby_logs.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT timezone FROM user_timezones WHERE user_id = ?', (user_id,))
-    result = cursor.fetchone()
-    conn.close()
-    if result and result[0]:
-        try:
-            return SimpleTimezone(result[0])
-        except:
-            pass
-    return MOSCOW_TZ
+    """Получает часовой пояс пользователя (из кэша, если уже загружен)"""
+    if user_id in _tz_cache:
+        return _tz_cache[user_id]
+    with DB_LOCK:
+        result = DB.execute(SQL_GET_TZ, (user_id,)).fetchone()
+        user_tz = MOSCOW_TZ
+        if result and result[0]:
+            try:
+                user_tz = SimpleTimezone(result[0])
+            except:
+                pass
+        _tz_cache[user_id] = user_tz  # Под блокировкой — как и в get_baby_name
+    return user_tz
+
+async def get_user_tz_async(user_id: int) -> SimpleTimezone:
+    """Часовой пояс без блокировки event loop: БД читается в потоке только при промахе кэша"""
+    if user_id in _tz_cache:
+        return _tz_cache[user_id]
+    return await asyncio.to_thread(get_user_tz, user_id)
+
+def has_user_tz(user_id: int) -> bool:
+    """Проверяет, выбран ли часовой пояс"""
+    with DB_LOCK:
+        return DB.execute(SQL_GET_TZ, (user_id,)).fetchone() is not None
 
 def save_user_tz(user_id: int, tz_str: str) -> bool:
     """Сохраняет часовой пояс"""
     if not SimpleTimezone.is_valid(tz_str):
         return False
-    conn = sqlite3.connect('baby_logs.db')
-    cursor = conn.cursor()
-    cursor.execute('INSERT OR REPLACE INTO user_timezones (user_id, timezone) VALUES (?, ?)', (user_id, tz_str))
-    conn.commit()
-    conn.close()
+    with DB_LOCK:
+        DB.execute(SQL_SAVE_TZ, (user_id, tz_str))
+        _tz_cache.pop(user_id, None)
     return True
 
+@functools.lru_cache(maxsize=4096)
 def format_duration(seconds: int) -> str:
-    """Форматирует секунды в чч:мм:сс"""
+    """Форматирует секунды в чч:мм:сс (кэшируется: длительности часто повторяются)"""
     hours, rem = divmod(seconds, 3600)
     mins, secs = divmod(rem, 60)
     return f'{hours:02d}:{mins:02d}:{secs:02d}'
 
 def get_average_interval(user_id: int, category: str) -> int:
-    """Вычисляет средний интервал между активностями (в секундах)"""
-    conn = sqlite3.connect('baby_logs.db')
-    cursor = conn.cursor()
-    
-    # Получаем последние 10 записей по категории
-    cursor.execute('''
-        SELECT date, time_start FROM baby_logs 
-        WHERE user_id = ? AND category = ?
-        ORDER BY date DESC, time_start DESC
-        LIMIT 10
-    ''', (user_id, category))
-    
-    records = cursor.fetchall()
-    conn.close()
-    
-    if len(records) < 2:
-        return None
-    
-    intervals = []
-    for i in range(len(records) - 1):
-        dt1 = datetime.fromisoformat(f"{records[i][0]} {records[i][1]}")
-        dt2 = datetime.fromisoformat(f"{records[i+1][0]} {records[i+1][1]}")
-        interval = abs((dt1 - dt2).total_seconds())
-        intervals.append(interval)
-    
-    return int(sum(intervals) / len(intervals)) if intervals else None
+    """Вычисляет средний интервал между активностями (в секундах, кэшируется на INTERVAL_CACHE_TTL)"""
+    key = (user_id, category)
+    cached = _interval_cache.get(key)
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+    
+    # Среднее по соседним парам из последних 10 записей считает SQLite;
+    # при менее чем двух записях AVG возвращает NULL
+    with DB_LOCK:
+        avg_interval = DB.execute(SQL_AVERAGE_INTERVAL, (user_id, category)).fetchone()[0]
+        avg_interval = int(avg_interval) if avg_interval is not None else None
+        # Под блокировкой, чтобы параллельная вставка не оставила устаревшее значение
+        now = time.monotonic()
+        if len(_interval_cache) >= INTERVAL_CACHE_MAXSIZE:
+            for stale in [k for k, (expires, _) in _interval_cache.items() if expires <= now]:
+                del _interval_cache[stale]
+            if len(_interval_cache) >= INTERVAL_CACHE_MAXSIZE:
+                _interval_cache.clear()  # Все записи свежие — проще начать заново
+        _interval_cache[key] = (now + INTERVAL_CACHE_TTL, avg_interval)
+    return avg_interval
+
+def get_average_intervals_bulk(user_id: int, categories) -> dict:
+    """Средние интервалы для нескольких категорий за один переход в поток.
+    Каждая категория — отдельный поиск LIMIT 10 по индексу через кэш get_average_interval:
+    это быстрее одного оконного запроса по всей истории пользователя"""
+    return {category: get_average_interval(user_id, category) for category in categories}
 
 def get_statistics(user_id: int):
     """Получает статистику пользователя"""
-    conn = sqlite3.connect('baby_logs.db')
-    cursor = conn.cursor()
-    
-    stats = {}
-    for category in ['ГВ', 'Сон', 'Смесь']:
-        cursor.execute('''
-            SELECT COUNT(*), SUM(duration), AVG(volume)
-            FROM baby_logs 
-            WHERE user_id = ? AND category = ?
-        ''', (user_id, category))
-        
-        count, total_duration, avg_volume = cursor.fetchone()
+    # Одним запросом по всем категориям; отсутствующие остаются нулевыми
+    stats = {category: {'count': 0, 'duration': 0, 'avg_volume': None} for category in ['ГВ', 'Сон', 'Смесь']}
+    with DB_LOCK:
+        rows = DB.execute(SQL_CATEGORY_STATS, (user_id,)).fetchall()
+    
+    for category, count, total_duration, avg_volume in rows:
         stats[category] = {
             'count': count or 0,
             'duration': total_duration or 0,
             'avg_volume': round(avg_volume, 1) if avg_volume else None
         }
     
-    conn.close()
     return stats
 
+def update_description(user_id: int, task_id: int, description: str):
+    """Сохраняет заметку к записи"""
+    with DB_LOCK:
+        DB.execute(SQL_UPDATE_DESCRIPTION, (description, task_id, user_id))
+
+def get_logs_for_date(user_id: int, date_str: str) -> list:
+    """Получает записи за дату"""
+    with DB_LOCK:
+        return DB.execute(SQL_LOGS_FOR_DATE, (user_id, date_str)).fetchall()
+
+def get_logs_for_category(user_id: int, category: str) -> list:
+    """Получает последние записи по категории"""
+    with DB_LOCK:
+        return DB.execute(SQL_LOGS_FOR_CATEGORY, (user_id, category)).fetchall()
+
+def export_logs_csv(user_id: int) -> tuple:
+    """Выгружает все записи в CSV, возвращает (число записей, байты файла)"""
+    csv_bytes = BytesIO()
+    count = 0
+    
+    # Один SELECT — сам по себе согласованное чтение; число записей
+    # считается по ходу выгрузки, строки идут потоком
+    with DB_LOCK:
+        cursor = DB.execute(SQL_EXPORT_LOGS, (user_id,))
+        rows = cursor.fetchmany(1000)
+        if rows:
+            # Генерируем CSV сразу в байтовый буфер, без промежуточной строки
+            output = TextIOWrapper(csv_bytes, encoding='utf-8-sig', newline='', write_through=True)
+            writer = csv.writer(output, lineterminator='\n')
+            writer.writerow(['Дата', 'Время', 'Категория', 'Длительность', 'Объем (мл)', 'Заметка'])
+            
+            while rows:
+                count += len(rows)
+                writer.writerows(
+                    (date_str, time_start, category, format_duration(duration), volume or '', description or '')
+                    for date_str, time_start, category, duration, volume, description in rows
+                )
+                rows = cursor.fetchmany(1000)
+            output.detach()
+    
+    return count, csv_bytes.getvalue()
+
+# ========== ОЧЕРЕДЬ ЗАПИСИ ==========
+async def save_log(user_id: int, category: str, duration: int, volume, date_str: str, time_start: str) -> int:
+    """Ставит запись активности в очередь и возвращает ее id после сброса"""
+    future = asyncio.get_running_loop().create_future()
+    await WRITE_QUEUE.put(((user_id, category, duration, volume, date_str, time_start), future))
+    return await future
+
+def write_log_batch(rows: list) -> list:
+    """Вставляет пачку записей одной транзакцией, возвращает их id"""
+    with DB_LOCK:
+        DB.execute('BEGIN IMMEDIATE')
+        try:
+            ids = [DB.execute(SQL_INSERT_LOG, row).fetchone()[0] for row in rows]
+        except Exception:
+            DB.execute('ROLLBACK')
+            raise
+        DB.execute('COMMIT')
+        for row in rows:
+            _interval_cache.pop((row[0], row[1]), None)  # Новая запись меняет средний интервал
+    return ids
+
+async def flush_logs():
+    """Фоновая задача: сбрасывает очередь записей в БД пачками"""
+    while True:
+        batch = [await WRITE_QUEUE.get()]
+        await asyncio.sleep(WRITE_FLUSH_DELAY)
+        while not WRITE_QUEUE.empty() and len(batch) < WRITE_BATCH_SIZE:
+            batch.append(WRITE_QUEUE.get_nowait())
+        
+        try:
+            ids = await asyncio.to_thread(write_log_batch, [row for row, _ in batch])
+        except Exception as e:
+            log.error('Ошибка записи пачки из %d записей: %s', len(batch), e)
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+                WRITE_QUEUE.task_done()
+            continue
+        
+        for (_, future), row_id in zip(batch, ids):
+            if not future.done():
+                future.set_result(row_id)
+            WRITE_QUEUE.task_done()
+
+load_active_sessions()
+
 # ========== КЛАВИАТУРЫ ==========
 def get_timezone_keyboard():
     """Клавиатура выбора часового пояса"""
@@ -261,8 +558,27 @@ def get_reports_submenu():
         one_time_keyboard=True
     )
 
+def get_description_keyboard():
+    """Вопрос о заметке после записи"""
+    return ReplyKeyboardMarkup(
+        keyboard=[[KeyboardButton(text='📝 Да'), KeyboardButton(text='⏭ Нет')]],
+        resize_keyboard=True,
+        one_time_keyboard=True
+    )
+
+# Статичные клавиатуры собираются один раз при загрузке модуля
+_TIMEZONE_KEYBOARD = get_timezone_keyboard()
+_MAIN_KEYBOARD = get_main_keyboard()
+_REPORTS_KEYBOARD = get_reports_submenu()
+_DESCRIPTION_KEYBOARD = get_description_keyboard()
+
+# Строка дней недели одинакова для всех месяцев
+CALENDAR_WEEKDAYS_ROW = [InlineKeyboardButton(text=day, callback_data=_NOOP)
+                         for day in ['Пн', 'Вт', 'Ср', 'Чт', 'Пт', 'Сб', 'Вс']]
+
+@functools.lru_cache(maxsize=64)
 def get_calendar_keyboard(year: int, month: int) -> InlineKeyboardMarkup:
-    """Создает инлайн-календарь"""
+    """Создает инлайн-календарь (кэшируется: зависит только от года и месяца)"""
     keyboard = []
     
     # Навигация
@@ -272,26 +588,23 @@ def get_calendar_keyboard(year: int, month: int) -> InlineKeyboardMarkup:
     next_month = 1 if month == 12 else month + 1
     
     keyboard.append([
-        InlineKeyboardButton(text='◀', callback_data=f'cal:{prev_year}:{prev_month:02d}'),
-        InlineKeyboardButton(text=f'{datetime(year, month, 1).strftime("%B %Y")}', callback_data='noop'),
-        InlineKeyboardButton(text='▶', callback_data=f'cal:{next_year}:{next_month:02d}')
+        InlineKeyboardButton(text='◀', callback_data=CalCB(year=prev_year, month=prev_month).pack()),
+        InlineKeyboardButton(text=f'{datetime(year, month, 1).strftime("%B %Y")}', callback_data=_NOOP),
+        InlineKeyboardButton(text='▶', callback_data=CalCB(year=next_year, month=next_month).pack())
     ])
     
     # Дни недели
-    days_of_week = ['Пн', 'Вт', 'Ср', 'Чт', 'Пт', 'Сб', 'Вс']
-    keyboard.append([InlineKeyboardButton(text=day, callback_data='noop') for day in days_of_week])
+    keyboard.append(CALENDAR_WEEKDAYS_ROW)
     
     # Дни месяца
-    first_day = datetime(year, month, 1)
-    last_day = datetime(year, month + 1, 1) - timedelta(days=1) if month < 12 else datetime(year + 1, 1, 1) - timedelta(days=1)
-    start_weekday = first_day.weekday()
+    start_weekday, last_day_num = calendar.monthrange(year, month)
     
     week = []
     for _ in range(start_weekday):
-        week.append(InlineKeyboardButton(text=' ', callback_data='noop'))
+        week.append(InlineKeyboardButton(text=' ', callback_data=_NOOP))
     
-    for day in range(1, last_day.day + 1):
-        week.append(InlineKeyboardButton(text=str(day), callback_data=f'date:{year}:{month:02d}:{day:02d}'))
+    for day in range(1, last_day_num + 1):
+        week.append(InlineKeyboardButton(text=str(day), callback_data=DateCB(year=year, month=month, day=day).pack()))
         if len(week) == 7:
             keyboard.append(week)
             week = []
@@ -299,36 +612,39 @@ def get_calendar_keyboard(year: int, month: int) -> InlineKeyboardMarkup:
     if week:
         keyboard.append(week)
     
-    keyboard.append([InlineKeyboardButton(text='❌ Отмена', callback_data='cancel_calendar')])
+    keyboard.append([InlineKeyboardButton(text='❌ Отмена', callback_data=_CANCEL_CAL)])
     return InlineKeyboardMarkup(inline_keyboard=keyboard)
 
 def get_categories_keyboard(user_id: int) -> InlineKeyboardMarkup:
     """Клавиатура выбора категории для отчета"""
-    conn = sqlite3.connect('baby_logs.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT DISTINCT category FROM baby_logs WHERE user_id = ? ORDER BY category', (user_id,))
-    cats = cursor.fetchall()
-    conn.close()
+    with DB_LOCK:
+        cats = DB.execute(SQL_USER_CATEGORIES, (user_id,)).fetchall()
     
     keyboard = []
     row = []
     for cat, in cats:
-        row.append(InlineKeyboardButton(text=cat, callback_data=f'cat:{cat}'))
+        row.append(InlineKeyboardButton(text=cat, callback_data=CatCB(name=cat).pack()))
         if len(row) == 2:
             keyboard.append(row)
             row = []
     if row:
         keyboard.append(row)
     
-    keyboard.append([InlineKeyboardButton(text='❌ Отмена', callback_data='cancel_cat')])
+    keyboard.append([InlineKeyboardButton(text='❌ Отмена', callback_data=_CANCEL_CAT)])
     return InlineKeyboardMarkup(inline_keyboard=keyboard)
 
 # ========== УВЕДОМЛЕНИЯ ==========
-async def schedule_reminder(user_id: int, category: str, interval: int):
-    """Планирует напоминание о следующем кормлении"""
+def schedule_reminder(user_id: int, category: str, interval: int):
+    """Планирует напоминание о следующем кормлении (заменяет предыдущее)"""
+    seq = next(_reminder_counter)
+    _reminder_seq[user_id] = seq
+    heapq.heappush(_reminders, (time.time() + interval, seq, user_id, category, interval))
+    _reminders_changed.set()
+
+async def send_reminder(user_id: int, category: str, interval: int):
+    """Отправляет напоминание"""
     try:
-        await asyncio.sleep(interval)
-        baby_name = get_baby_name(user_id)
+        baby_name = await get_baby_name_async(user_id)
         
         messages = {
             'ГВ': f'🍼 Пора покормить {baby_name}! Прошло {format_duration(interval)}',
@@ -337,10 +653,32 @@ async def schedule_reminder(user_id: int, category: str, interval: int):
         }
         
         await bot.send_message(user_id, messages.get(category, f'⏰ Напоминание: {category}'))
-    except asyncio.CancelledError:
-        pass
     except Exception as e:
-        print(f'Ошибка напоминания для {user_id}: {e}')
+        log.error('Ошибка напоминания для %s: %s', user_id, e)
+
+async def reminder_scheduler():
+    """Фоновая задача: одна на все напоминания, спит до ближайшего в куче"""
+    while True:
+        _reminders_changed.clear()
+        if not _reminders:
+            await _reminders_changed.wait()
+            continue
+        
+        fire_at, seq, user_id, category, interval = _reminders[0]
+        delay = fire_at - time.time()
+        if delay > 0:
+            # Просыпаемся по времени или раньше, если добавили более близкое
+            try:
+                await asyncio.wait_for(_reminders_changed.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+            continue
+        
+        heapq.heappop(_reminders)
+        if _reminder_seq.get(user_id) != seq:
+            continue  # Напоминание заменено более новым
+        del _reminder_seq[user_id]
+        await send_reminder(user_id, category, interval)
 
 # ========== ОБРАБОТЧИКИ КОМАНД ==========
 @dp.message(Command('start'))
@@ -349,10 +687,10 @@ async def start_handler(message: types.Message, state: FSMContext):
     username = message.from_user.username
     first_name = message.from_user.first_name
     
-    log_user(user_id, username, first_name)
+    await asyncio.to_thread(log_user, user_id, username, first_name)
     
     # Проверяем наличие имени ребенка
-    baby_name = get_baby_name(user_id)
+    baby_name = await get_baby_name_async(user_id)
     if baby_name == 'Малыш':
         await state.set_state(BabyStates.waiting_baby_name)
         await message.answer(
@@ -362,19 +700,13 @@ async def start_handler(message: types.Message, state: FSMContext):
         return
     
     # Проверяем часовой пояс
-    conn = sqlite3.connect('baby_logs.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT timezone FROM user_timezones WHERE user_id = ?', (user_id,))
-    has_tz = cursor.fetchone()
-    conn.close()
-    
-    if not has_tz:
+    if not await asyncio.to_thread(has_user_tz, user_id):
         await state.set_state(BabyStates.waiting_timezone_choice)
-        await message.answer('🌍 Выберите часовой пояс:', reply_markup=get_timezone_keyboard())
+        await message.answer('🌍 Выберите часовой пояс:', reply_markup=_TIMEZONE_KEYBOARD)
     else:
         await message.answer(
             f'👶 С возвращением! Продолжаем следить за {baby_name}!',
-            reply_markup=get_main_keyboard()
+            reply_markup=_MAIN_KEYBOARD
         )
 
 @dp.message(BabyStates.waiting_baby_name)
@@ -382,12 +714,12 @@ async def handle_baby_name(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
     baby_name = message.text.strip()[:50]  # Ограничение 50 символов
     
-    update_baby_name(user_id, baby_name)
+    await asyncio.to_thread(update_baby_name, user_id, baby_name)
     
     await state.set_state(BabyStates.waiting_timezone_choice)
     await message.answer(
         f'✅ Отлично! Теперь выберите часовой пояс:',
-        reply_markup=get_timezone_keyboard()
+        reply_markup=_TIMEZONE_KEYBOARD
     )
 
 @dp.message(BabyStates.waiting_timezone_choice)
@@ -395,23 +727,13 @@ async def handle_timezone_choice(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
     text = message.text.strip()
     
-    timezone_map = {
-        '🇷🇺 Москва (UTC+3)': 'Europe/Moscow',
-        '🇬🇪 Батуми (UTC+4)': 'Asia/Tbilisi',
-        '🇷🇺 Самара (UTC+4)': 'Europe/Samara',
-        '🇷🇺 Екатеринбург (UTC+5)': 'Asia/Yekaterinburg',
-        '🇬🇧 Лондон (UTC+0)': 'Europe/London',
-        '🇹🇭 Бангкок (UTC+7)': 'Asia/Bangkok',
-        '⏭️ Пропустить': 'Europe/Moscow'
-    }
-    
-    if text in timezone_map:
-        save_user_tz(user_id, timezone_map[text])
+    if text in _TIMEZONE_MAP:
+        await asyncio.to_thread(save_user_tz, user_id, _TIMEZONE_MAP[text])
         await state.clear()
-        baby_name = get_baby_name(user_id)
+        baby_name = await get_baby_name_async(user_id)
         await message.answer(
             f'🎉 Готово! Начинаем следить за {baby_name}!',
-            reply_markup=get_main_keyboard()
+            reply_markup=_MAIN_KEYBOARD
         )
     elif text == '🌍 Другой пояс':
         await state.set_state(BabyStates.waiting_custom_timezone)
@@ -421,20 +743,20 @@ async def handle_timezone_choice(message: types.Message, state: FSMContext):
             'Asia/Yekaterinburg, Europe/London, Asia/Bangkok'
         )
     else:
-        await message.answer('Выберите из предложенных вариантов:', reply_markup=get_timezone_keyboard())
+        await message.answer('Выберите из предложенных вариантов:', reply_markup=_TIMEZONE_KEYBOARD)
 
 @dp.message(BabyStates.waiting_custom_timezone)
 async def handle_custom_timezone(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
     tz_str = message.text.strip()
     
-    if save_user_tz(user_id, tz_str):
+    if await asyncio.to_thread(save_user_tz, user_id, tz_str):
         await state.clear()
-        baby_name = get_baby_name(user_id)
+        baby_name = await get_baby_name_async(user_id)
         await message.answer(
             f'✅ Часовой пояс {tz_str} установлен!\n\n'
             f'🎉 Начинаем следить за {baby_name}!',
-            reply_markup=get_main_keyboard()
+            reply_markup=_MAIN_KEYBOARD
         )
     else:
         await message.answer(
@@ -444,53 +766,42 @@ async def handle_custom_timezone(message: types.Message, state: FSMContext):
         )
 
 # ========== СТАРТ/СТОП АКТИВНОСТЕЙ ==========
-@dp.message(F.text.in_(['🍼 ГВ', '😴 Сон', '🍶 Смесь']))
+@dp.message(F.text.in_(frozenset(_CATEGORY_FROM_BTN)))
 async def start_activity(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
     
-    if user_id in active_timers:
+    category = _CATEGORY_FROM_BTN[message.text]
+    
+    if not await asyncio.to_thread(start_session, user_id, category, date.today().isoformat()):
         await message.answer('⏳ Уже идет отсчет! Нажмите "⏹ Стоп" для завершения.')
         return
     
-    category_map = {'🍼 ГВ': 'ГВ', '😴 Сон': 'Сон', '🍶 Смесь': 'Смесь'}
-    category = category_map[message.text]
-    
-    active_timers[user_id] = {
-        'start': time.time(),
-        'category': category,
-        'date': date.today().isoformat()
-    }
-    
-    baby_name = get_baby_name(user_id)
-    emoji_map = {'ГВ': '🍼', 'Сон': '😴', 'Смесь': '🍶'}
-    
+    baby_name = await get_baby_name_async(user_id)
     await message.answer(
-        f'{emoji_map[category]} {category} для {baby_name} начато!\n'
+        f'{_EMOJI[category]} {category} для {baby_name} начато!\n'
         f'⏱ Таймер запущен...',
-        reply_markup=get_main_keyboard()
+        reply_markup=_MAIN_KEYBOARD
     )
 
 @dp.message(F.text == '⏹ Стоп')
 async def stop_activity(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
     
-    if user_id not in active_timers:
+    timer = await asyncio.to_thread(stop_session, user_id)
+    if timer is None:
         await message.answer('⏰ Таймер не запущен! Выберите активность для начала.')
         return
     
-    timer_data = active_timers.pop(user_id)
-    start_time = timer_data['start']
-    category = timer_data['category']
-    date_str = timer_data['date']
+    start_time, category, date_str = timer
     
     elapsed = int(time.time() - start_time)
     time_str = format_duration(elapsed)
     
-    user_tz = get_user_tz(user_id)
+    user_tz = await get_user_tz_async(user_id)
     now_user = user_tz.get_current_time()
     timestart_str = now_user.strftime('%H:%M')
     
-    baby_name = get_baby_name(user_id)
+    baby_name = await get_baby_name_async(user_id)
     
     # Если Смесь - запрашиваем объем
     if category == 'Смесь':
@@ -504,40 +815,24 @@ async def stop_activity(message: types.Message, state: FSMContext):
         await message.answer(f'🍶 {baby_name} покушал(а)!\n⏱ Время: {time_str}\n\n💧 Введите объем смеси (мл):')
     else:
         # Сохраняем без объема
-        conn = sqlite3.connect('baby_logs.db')
-        cursor = conn.cursor()
-        cursor.execute('''
-            INSERT INTO baby_logs (user_id, category, duration, volume, date, time_start, description)
-            VALUES (?, ?, ?, NULL, ?, ?, NULL)
-        ''', (user_id, category, elapsed, date_str, timestart_str))
-        task_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
+        task_id = await save_log(user_id, category, elapsed, None, date_str, timestart_str)
         
-        emoji_map = {'ГВ': '🍼', 'Сон': '😴'}
         await message.answer(
-            f'{emoji_map[category]} {category} завершено!\n'
+            f'{_EMOJI[category]} {category} завершено!\n'
             f'👶 {baby_name}\n'
             f'⏱ Время: {time_str}\n'
             f'📅 {date_str}',
-            reply_markup=get_main_keyboard()
+            reply_markup=_MAIN_KEYBOARD
         )
         
         # Планируем напоминание
-        avg_interval = get_average_interval(user_id, category)
+        avg_interval = await asyncio.to_thread(get_average_interval, user_id, category)
         if avg_interval and avg_interval > 300:  # Минимум 5 минут
-            if user_id in reminder_tasks:
-                reminder_tasks[user_id].cancel()
-            reminder_tasks[user_id] = asyncio.create_task(schedule_reminder(user_id, category, avg_interval))
+            schedule_reminder(user_id, category, avg_interval)
         
         # Предлагаем добавить описание
         await state.update_data(last_task_id=task_id)
-        desc_kb = ReplyKeyboardMarkup(
-            keyboard=[[KeyboardButton(text='📝 Да'), KeyboardButton(text='⏭ Нет')]],
-            resize_keyboard=True,
-            one_time_keyboard=True
-        )
-        await message.answer('Добавить заметку?', reply_markup=desc_kb)
+        await message.answer('Добавить заметку?', reply_markup=_DESCRIPTION_KEYBOARD)
         await state.set_state(BabyStates.waiting_description_choice)
 
 @dp.message(BabyStates.waiting_volume)
@@ -559,17 +854,9 @@ async def handle_volume(message: types.Message, state: FSMContext):
     timestart_str = data['last_start']
     date_str = data['last_date']
     
-    conn = sqlite3.connect('baby_logs.db')
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT INTO baby_logs (user_id, category, duration, volume, date, time_start, description)
-        VALUES (?, ?, ?, ?, ?, ?, NULL)
-    ''', (user_id, category, elapsed, volume, date_str, timestart_str))
-    task_id = cursor.lastrowid
-    conn.commit()
-    conn.close()
-    
-    baby_name = get_baby_name(user_id)
+    task_id = await save_log(user_id, category, elapsed, volume, date_str, timestart_str)
+    
+    baby_name = await get_baby_name_async(user_id)
     time_str = format_duration(elapsed)
     
     await message.answer(
@@ -578,24 +865,17 @@ async def handle_volume(message: types.Message, state: FSMContext):
         f'⏱ Время: {time_str}\n'
         f'💧 Объем: {volume} мл\n'
         f'📅 {date_str}',
-        reply_markup=get_main_keyboard()
+        reply_markup=_MAIN_KEYBOARD
     )
     
     # Планируем напоминание
-    avg_interval = get_average_interval(user_id, category)
+    avg_interval = await asyncio.to_thread(get_average_interval, user_id, category)
     if avg_interval and avg_interval > 300:
-        if user_id in reminder_tasks:
-            reminder_tasks[user_id].cancel()
-        reminder_tasks[user_id] = asyncio.create_task(schedule_reminder(user_id, category, avg_interval))
+        schedule_reminder(user_id, category, avg_interval)
     
     # Предлагаем описание
     await state.update_data(last_task_id=task_id)
-    desc_kb = ReplyKeyboardMarkup(
-        keyboard=[[KeyboardButton(text='📝 Да'), KeyboardButton(text='⏭ Нет')]],
-        resize_keyboard=True,
-        one_time_keyboard=True
-    )
-    await message.answer('Добавить заметку?', reply_markup=desc_kb)
+    await message.answer('Добавить заметку?', reply_markup=_DESCRIPTION_KEYBOARD)
     await state.set_state(BabyStates.waiting_description_choice)
 
 @dp.message(BabyStates.waiting_description_choice)
@@ -604,7 +884,7 @@ async def handle_description_choice(message: types.Message, state: FSMContext):
     
     if text == '⏭ Нет':
         await state.clear()
-        await message.answer('✅ Готово!', reply_markup=get_main_keyboard())
+        await message.answer('✅ Готово!', reply_markup=_MAIN_KEYBOARD)
     elif text == '📝 Да':
         await state.set_state(BabyStates.waiting_description_text)
         await message.answer('📝 Введите заметку (настроение, особенности и т.д.):')
@@ -619,125 +899,107 @@ async def save_description(message: types.Message, state: FSMContext):
     
     if not task_id:
         await state.clear()
-        await message.answer('❌ Ошибка сохранения', reply_markup=get_main_keyboard())
+        await message.answer('❌ Ошибка сохранения', reply_markup=_MAIN_KEYBOARD)
         return
     
     description = message.text.strip()[:500]  # Ограничение 500 символов
     
-    conn = sqlite3.connect('baby_logs.db')
-    cursor = conn.cursor()
-    cursor.execute('UPDATE baby_logs SET description = ? WHERE id = ? AND user_id = ?',
-                   (description, task_id, user_id))
-    conn.commit()
-    conn.close()
+    await asyncio.to_thread(update_description, user_id, task_id, description)
     
     await state.clear()
-    await message.answer('✅ Заметка сохранена!', reply_markup=get_main_keyboard())
+    await message.answer('✅ Заметка сохранена!', reply_markup=_MAIN_KEYBOARD)
 
 # ========== ОТЧЕТЫ ==========
 async def send_report_for_date(user_id: int, report_date: date, message: types.Message):
     """Отчет по дате"""
     date_str = report_date.isoformat()
-    baby_name = get_baby_name(user_id)
+    baby_name = await get_baby_name_async(user_id)
     
-    conn = sqlite3.connect('baby_logs.db')
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT category, duration, volume, time_start, description
-        FROM baby_logs
-        WHERE user_id = ? AND date = ?
-        ORDER BY time_start
-    ''', (user_id, date_str))
-    
-    logs = cursor.fetchall()
-    conn.close()
+    logs = await asyncio.to_thread(get_logs_for_date, user_id, date_str)
     
     if not logs:
-        await message.answer(f'📊 За {date_str} записей нет.')
+        await message.answer(f'📊 За {date_str} записей нет.', reply_markup=_MAIN_KEYBOARD)
         return
     
-    report_text = f'📊 *Отчет за {date_str}*\n👶 {baby_name}\n\n'
+    parts = [f'📊 <b>Отчет за {date_str}</b>\n👶 {html.escape(baby_name)}\n\n']
     
     stats_by_cat = {}
     for category, duration, volume, time_start, description in logs:
         if category not in stats_by_cat:
-            stats_by_cat[category] = {'count': 0, 'duration': 0, 'volumes': []}
-        stats_by_cat[category]['count'] += 1
-        stats_by_cat[category]['duration'] += duration
+            stats_by_cat[category] = {'count': 0, 'duration': 0, 'vol_sum': 0, 'vol_n': 0}
+        cat_stats = stats_by_cat[category]
+        cat_stats['count'] += 1
+        cat_stats['duration'] += duration
         if volume:
-            stats_by_cat[category]['volumes'].append(volume)
+            cat_stats['vol_sum'] += volume
+            cat_stats['vol_n'] += 1
     
     for category, stats in stats_by_cat.items():
-        emoji = {'ГВ': '🍼', 'Сон': '😴', 'Смесь': '🍶'}[category]
+        emoji = _EMOJI[category]
         time_str = format_duration(stats['duration'])
-        report_text += f'{emoji} *{category}*: {stats["count"]}x, ⏱ {time_str}'
-        if stats['volumes']:
-            avg_vol = sum(stats['volumes']) / len(stats['volumes'])
-            report_text += f', 💧 {int(avg_vol)} мл сред.'
-        report_text += '\n'
+        parts.append(f'{emoji} <b>{category}</b>: {stats["count"]}x, ⏱ {time_str}')
+        if stats['vol_n']:
+            avg_vol = stats['vol_sum'] / stats['vol_n']
+            parts.append(f', 💧 {int(avg_vol)} мл сред.')
+        parts.append('\n')
     
-    report_text += '\n*Детали:*\n'
+    parts.append('\n<b>Детали:</b>\n')
     for category, duration, volume, time_start, description in logs:
-        emoji = {'ГВ': '🍼', 'Сон': '😴', 'Смесь': '🍶'}[category]
+        emoji = _EMOJI[category]
         time_str = format_duration(duration)
-        report_text += f'{time_start} | {emoji} {category}: {time_str}'
+        parts.append(f'{time_start} | {emoji} {category}: {time_str}')
         if volume:
-            report_text += f' ({volume} мл)'
+            parts.append(f' ({volume} мл)')
         if description:
-            report_text += f'\n  💬 {description}'
-        report_text += '\n'
+            parts.append(f'\n  💬 {html.escape(description)}')
+        parts.append('\n')
     
-    await message.answer(report_text, parse_mode='Markdown', reply_markup=get_main_keyboard())
+    await message.answer(''.join(parts), parse_mode='HTML', reply_markup=_MAIN_KEYBOARD)
 
 async def send_report_for_category(user_id: int, category: str, message: types.Message):
     """Отчет по категории"""
-    baby_name = get_baby_name(user_id)
-    
-    conn = sqlite3.connect('baby_logs.db')
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT date, duration, volume, time_start, description
-        FROM baby_logs
-        WHERE user_id = ? AND category = ?
-        ORDER BY date DESC, time_start DESC
-        LIMIT 20
-    ''', (user_id, category))
+    baby_name = await get_baby_name_async(user_id)
     
-    logs = cursor.fetchall()
-    conn.close()
+    logs = await asyncio.to_thread(get_logs_for_category, user_id, category)
     
     if not logs:
-        await message.answer(f'📋 Нет записей для категории "{category}".')
+        await message.answer(f'📋 Нет записей для категории "{category}".', reply_markup=_MAIN_KEYBOARD)
         return
     
-    total_duration = sum(log[1] for log in logs)
-    volumes = [log[2] for log in logs if log[2]]
+    # Один проход: суммарное время и средний объем без промежуточного списка
+    total_duration = 0
+    vol_sum = vol_n = 0
+    for _, duration, volume, _, _ in logs:
+        total_duration += duration
+        if volume:
+            vol_sum += volume
+            vol_n += 1
     
-    emoji = {'ГВ': '🍼', 'Сон': '😴', 'Смесь': '🍶'}[category]
-    report_text = f'📋 *Отчет: {emoji} {category}*\n👶 {baby_name}\n\n'
-    report_text += f'*Записей:* {len(logs)}\n'
-    report_text += f'*Общее время:* {format_duration(total_duration)}\n'
+    emoji = _EMOJI[category]
+    parts = [f'📋 <b>Отчет: {emoji} {category}</b>\n👶 {html.escape(baby_name)}\n\n']
+    parts.append(f'<b>Записей:</b> {len(logs)}\n')
+    parts.append(f'<b>Общее время:</b> {format_duration(total_duration)}\n')
     
-    if volumes:
-        avg_vol = sum(volumes) / len(volumes)
-        report_text += f'*Средний объем:* {int(avg_vol)} мл\n'
+    if vol_n:
+        avg_vol = vol_sum / vol_n
+        parts.append(f'<b>Средний объем:</b> {int(avg_vol)} мл\n')
     
-    report_text += '\n*Последние записи:*\n'
+    parts.append('\n<b>Последние записи:</b>\n')
     for date_str, duration, volume, time_start, description in logs[:10]:
         time_str = format_duration(duration)
-        report_text += f'{date_str} {time_start}: {time_str}'
+        parts.append(f'{date_str} {time_start}: {time_str}')
         if volume:
-            report_text += f' ({volume} мл)'
+            parts.append(f' ({volume} мл)')
         if description:
-            report_text += f'\n  💬 {description}'
-        report_text += '\n'
+            parts.append(f'\n  💬 {html.escape(description)}')
+        parts.append('\n')
     
-    await message.answer(report_text, parse_mode='Markdown', reply_markup=get_main_keyboard())
+    await message.answer(''.join(parts), parse_mode='HTML', reply_markup=_MAIN_KEYBOARD)
 
 @dp.message(F.text == '📊 Отчет')
 async def show_reports_menu(message: types.Message, state: FSMContext):
     await state.set_state(BabyStates.waiting_reports_menu)
-    await message.answer('Выберите тип отчета:', reply_markup=get_reports_submenu())
+    await message.answer('Выберите тип отчета:', reply_markup=_REPORTS_KEYBOARD)
 
 @dp.message(BabyStates.waiting_reports_menu, F.text == '📄 За сегодня')
 async def report_today(message: types.Message, state: FSMContext):
@@ -748,12 +1010,13 @@ async def report_today(message: types.Message, state: FSMContext):
 async def ask_report_date(message: types.Message, state: FSMContext):
     today = date.today()
     await state.set_state(BabyStates.choosing_calendar_month)
-    await message.answer('📅 Выберите дату:', reply_markup=get_calendar_keyboard(today.year, today.month))
+    sent = await message.answer('📅 Выберите дату:', reply_markup=get_calendar_keyboard(today.year, today.month))
+    _last_cal_view[sent.chat.id] = (sent.message_id, today.year, today.month)  # Вытесняет прежний календарь
 
 @dp.message(BabyStates.waiting_reports_menu, F.text == '📋 По категории')
 async def ask_report_category(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
-    cat_kb = get_categories_keyboard(user_id)
+    cat_kb = await asyncio.to_thread(get_categories_keyboard, user_id)
     
     if len(cat_kb.inline_keyboard) == 1:  # Только кнопка отмены
         await message.answer('📋 У вас нет записей.')
@@ -767,143 +1030,208 @@ async def export_csv(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
     await state.clear()
     
-    conn = sqlite3.connect('baby_logs.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT COUNT(*) FROM baby_logs WHERE user_id = ?', (user_id,))
-    count = cursor.fetchone()[0]
+    count, csv_data = await asyncio.to_thread(export_logs_csv, user_id)
     
     if count == 0:
         await message.answer('❌ У вас нет записей для экспорта.')
         return
     
-    cursor.execute('''
-        SELECT date, time_start, category, duration, volume, description
-        FROM baby_logs
-        WHERE user_id = ?
-        ORDER BY date DESC, time_start DESC
-    ''', (user_id,))
-    logs = cursor.fetchall()
-    conn.close()
-    
-    # Генерируем CSV
-    output = StringIO()
-    writer = csv.writer(output, lineterminator='\n')
-    writer.writerow(['Дата', 'Время', 'Категория', 'Длительность', 'Объем (мл)', 'Заметка'])
-    
-    for log in logs:
-        date_str, time_start, category, duration, volume, description = log
-        duration_str = format_duration(duration)
-        writer.writerow([date_str, time_start, category, duration_str, volume or '', description or ''])
-    
-    csv_bytes = BytesIO(output.getvalue().encode('utf-8-sig'))
-    csv_bytes.seek(0)
-    
-    baby_name = get_baby_name(user_id)
+    baby_name = await get_baby_name_async(user_id)
     await message.answer_document(
         document=types.BufferedInputFile(
-            file=csv_bytes.getvalue(),
+            file=csv_data,
             filename=f'baby_{baby_name}_{date.today().isoformat()}.csv'
         ),
         caption=f'📊 Данные о {baby_name}\n📋 Записей: {count}'
     )
-    await message.answer('✅ Готово!', reply_markup=get_main_keyboard())
+    await message.answer('✅ Готово!', reply_markup=_MAIN_KEYBOARD)
 
 @dp.message(BabyStates.waiting_reports_menu, F.text == '⬅️ Назад')
 async def back_to_main(message: types.Message, state: FSMContext):
     await state.clear()
-    await message.answer('Главное меню', reply_markup=get_main_keyboard())
+    await message.answer('Главное меню', reply_markup=_MAIN_KEYBOARD)
 
 @dp.message(F.text == '📈 Статистика')
 async def show_statistics(message: types.Message):
     user_id = message.from_user.id
-    baby_name = get_baby_name(user_id)
-    stats = get_statistics(user_id)
+    baby_name = await get_baby_name_async(user_id)
+    stats = await asyncio.to_thread(get_statistics, user_id)
+    intervals = await asyncio.to_thread(get_average_intervals_bulk, user_id, tuple(stats))
     
-    report = f'📈 *Статистика*\n👶 {baby_name}\n\n'
+    parts = [f'📈 <b>Статистика</b>\n👶 {html.escape(baby_name)}\n\n']
     
     for category, data in stats.items():
-        emoji = {'ГВ': '🍼', 'Сон': '😴', 'Смесь': '🍶'}[category]
-        report += f'{emoji} *{category}*\n'
-        report += f'  Записей: {data["count"]}\n'
+        parts.append(f'{_EMOJI[category]} <b>{category}</b>\n  Записей: {data["count"]}\n')
         if data['duration'] > 0:
-            report += f'  Время: {format_duration(data["duration"])}\n'
+            parts.append(f'  Время: {format_duration(data["duration"])}\n')
         if data['avg_volume']:
-            report += f'  Средний объем: {data["avg_volume"]} мл\n'
+            parts.append(f'  Средний объем: {data["avg_volume"]} мл\n')
         
-        # Средний интервал
-        avg_interval = get_average_interval(user_id, category)
-        if avg_interval:
-            report += f'  Интервал: ~{format_duration(avg_interval)}\n'
-        report += '\n'
+        # Средний интервал; пустая строка отделяет категории
+        avg_interval = intervals.get(category)
+        parts.append(f'  Интервал: ~{format_duration(avg_interval)}\n\n' if avg_interval else '\n')
     
-    await message.answer(report, parse_mode='Markdown')
+    await message.answer(''.join(parts), parse_mode='HTML')
 
 # ========== CALLBACK HANDLERS ==========
-@dp.callback_query(F.data.startswith('cal:'))
-async def handle_calendar_nav(callback: types.CallbackQuery):
+# Все инлайн-кнопки идут через один обработчик: префикс до ':' выбирает
+# функцию из CALLBACK_ROUTES; кнопки с параметрами разбирают callback.data
+# своим классом CallbackData
+async def handle_calendar_nav(callback: types.CallbackQuery, state: FSMContext):
     try:
-        parts = callback.data.split(':')
-        year, month = int(parts[1]), int(parts[2])
-        await callback.message.edit_reply_markup(reply_markup=get_calendar_keyboard(year, month))
-        await callback.answer()
-    except:
+        cb = CalCB.unpack(callback.data)
+    except (TypeError, ValueError):  # Не то число частей или не числа
+        cb = None
+    # Год вне MINYEAR..MAXYEAR уронил бы построение календаря
+    if cb is None or not 1 <= cb.month <= 12 or not MINYEAR <= cb.year <= MAXYEAR:
         await callback.answer('Ошибка навигации', show_alert=False)
+        return
+    year, month = cb.year, cb.month
+    
+    # Повторное нажатие на тот же месяц не требует запроса к Telegram
+    chat_id = callback.message.chat.id
+    view = (callback.message.message_id, year, month)
+    if _last_cal_view.get(chat_id) == view:
+        await callback.answer()
+        return
+    
+    # Правка клавиатуры и ответ на нажатие независимы — отправляем параллельно.
+    # Методы aiogram — awaitable-объекты, а не корутины: gather их не примет без ensure_future
+    edited, answered = await asyncio.gather(
+        asyncio.ensure_future(callback.message.edit_reply_markup(reply_markup=get_calendar_keyboard(year, month))),
+        asyncio.ensure_future(callback.answer()),
+        return_exceptions=True,
+    )
+    if not isinstance(edited, BaseException):
+        _last_cal_view[chat_id] = view
+    for result in (edited, answered):
+        # "message is not modified" и т.п. — клавиатура уже на месте
+        if isinstance(result, BaseException) and not isinstance(result, TelegramBadRequest):
+            raise result
 
-@dp.callback_query(F.data.startswith('date:'))
 async def handle_date_selection(callback: types.CallbackQuery, state: FSMContext):
     try:
-        parts = callback.data.split(':')
-        year, month, day = int(parts[1]), int(parts[2]), int(parts[3])
-        selected_date = date(year, month, day)
-        
-        await callback.message.delete()
-        await state.clear()
-        await send_report_for_date(callback.from_user.id, selected_date, callback.message)
-    except:
+        cb = DateCB.unpack(callback.data)
+        selected_date = date(cb.year, cb.month, cb.day)
+    except (TypeError, ValueError):  # Битые данные или несуществующая дата, например 30 февраля
+        selected_date = None
+    if selected_date is None:
         await callback.answer('Ошибка обработки даты', show_alert=False)
+        return
+    
+    _last_cal_view.pop(callback.message.chat.id, None)
+    
+    # Календарь убираем, отчет приходит новым сообщением: только так вернется
+    # главная клавиатура (edit_text принимает лишь инлайн-кнопки)
+    with suppress(TelegramBadRequest):
+        await callback.message.delete()
+    await state.clear()
+    await send_report_for_date(callback.from_user.id, selected_date, callback.message)
+    await callback.answer()
 
-@dp.callback_query(F.data.startswith('cat:'))
 async def handle_category_selection(callback: types.CallbackQuery, state: FSMContext):
     try:
-        category = callback.data.split(':', 1)[1]
+        category = CatCB.unpack(callback.data).name
+    except (TypeError, ValueError):
+        await callback.answer('Ошибка обработки категории', show_alert=False)
+        return
+    
+    with suppress(TelegramBadRequest):
         await callback.message.delete()
-        await state.clear()
-        await send_report_for_category(callback.from_user.id, category, callback.message)
-    except:
-        await callback.answer('Ошибка выбора категории', show_alert=False)
+    await state.clear()
+    await send_report_for_category(callback.from_user.id, category, callback.message)
+    await callback.answer()
 
-@dp.callback_query(F.data == 'cancel_calendar')
 async def cancel_calendar(callback: types.CallbackQuery, state: FSMContext):
+    _last_cal_view.pop(callback.message.chat.id, None)
     await state.clear()
-    await callback.message.delete()
+    with suppress(TelegramBadRequest):  # Сообщение уже удалено или старше 48 часов
+        await callback.message.delete()
     await callback.answer()
 
-@dp.callback_query(F.data == 'cancel_cat')
 async def cancel_category(callback: types.CallbackQuery, state: FSMContext):
     await state.clear()
-    await callback.message.delete()
+    with suppress(TelegramBadRequest):
+        await callback.message.delete()
     await callback.answer()
 
-@dp.callback_query(F.data == 'noop')
-async def handle_noop(callback: types.CallbackQuery):
+async def handle_noop(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer()
 
+CALLBACK_ROUTES = {
+    _CAL: handle_calendar_nav,
+    _DATE: handle_date_selection,
+    _CAT: handle_category_selection,
+    _CANCEL_CAL: cancel_calendar,
+    _CANCEL_CAT: cancel_category,
+    _NOOP: handle_noop,
+}
+
+@dp.callback_query.outer_middleware()
+async def limit_callback_concurrency(handler, event: types.CallbackQuery, data: dict):
+    """Ограничивает число одновременно обрабатываемых нажатий: лишние ждут своей очереди"""
+    async with _callback_sem:
+        return await handler(event, data)
+
+@dp.callback_query()
+async def route_callback(callback: types.CallbackQuery, state: FSMContext):
+    prefix = (callback.data or '').partition(':')[0]
+    handler = CALLBACK_ROUTES.get(prefix)
+    if handler is None:
+        await callback.answer()
+        return
+    await handler(callback, state)
+
 # ========== FALLBACK ==========
 @dp.message()
 async def fallback_handler(message: types.Message):
     user_id = message.from_user.id
-    if user_id in active_timers:
+    if user_id in active_timer_users:
         await message.answer('⏳ Таймер активен! Нажмите "⏹ Стоп" для завершения.')
     else:
-        await message.answer('Используйте кнопки меню 👇', reply_markup=get_main_keyboard())
+        await message.answer('Используйте кнопки меню 👇', reply_markup=_MAIN_KEYBOARD)
 
 # ========== ЗАПУСК ==========
+async def run_webhook():
+    """Принимает обновления от Telegram через вебхук на aiohttp-сервере"""
+    app = web.Application()
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    
+    runner = web.AppRunner(app)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, WEBAPP_HOST, WEBAPP_PORT).start()
+        # Telegram присылает только те типы обновлений, на которые есть обработчики
+        await bot.set_webhook(f'{WEBHOOK_URL}{WEBHOOK_PATH}', secret_token=WEBHOOK_SECRET,
+                              allowed_updates=dp.resolve_used_update_types())
+        await asyncio.Event().wait()  # Работаем до остановки процесса
+    finally:
+        await runner.cleanup()
+
 async def main():
-    print('🚀 Бот запущен!')
-    await dp.start_polling(bot)
+    log.info('🚀 Бот запущен!')
+    flusher = asyncio.create_task(flush_logs())
+    scheduler = asyncio.create_task(reminder_scheduler())
+    optimizer = asyncio.create_task(optimize_db_periodically())
+    try:
+        if WEBHOOK_URL:
+            await run_webhook()
+        else:
+            await bot.delete_webhook()  # Иначе getUpdates конфликтует с оставшимся вебхуком
+            await dp.start_polling(bot)
+    finally:
+        scheduler.cancel()
+        optimizer.cancel()
+        await WRITE_QUEUE.join()  # Дописываем то, что уже в очереди
+        flusher.cancel()
+        await asyncio.to_thread(close_db)
+        await bot.session.close()
 
 if __name__ == '__main__':
-    try:
-        asyncio.run(main())
-    except KeyboardInterrupt:
-        print('👋 Бот остановлен')
\ No newline at end of file
+    # Без uvloop Runner создает стандартный цикл asyncio
+    with asyncio.Runner(loop_factory=uvloop.new_event_loop if uvloop else None) as runner:
+        try:
+            runner.run(main())
+        except KeyboardInterrupt:
+            log.info('👋 Бот остановлен')
\ No newline at end of file